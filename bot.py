@@ -4,7 +4,10 @@ import re
 import json
 import io
 import csv
-from typing import Dict, Tuple, Any, Optional
+import asyncio
+import threading
+import time
+from typing import Dict, List, Set, Tuple, Any, Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent, InputFile
 from telegram.ext import (
     Application,
@@ -18,16 +21,21 @@ from telegram.ext import (
     CallbackQueryHandler
 )
 import psycopg2
-from psycopg2 import extras
-from datetime import datetime, timedelta
+from psycopg2 import extras, pool
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain, count
+from operator import add
+from contextlib import closing, contextmanager
+from datetime import date, datetime, timedelta
 from urllib.parse import urlparse
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict
 from calendar import monthrange
 
 # Настройка логгирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     handlers=[
         logging.FileHandler('bot.log'),
         logging.StreamHandler()
@@ -38,13 +46,21 @@ logger = logging.getLogger(__name__)
 # Конфигурация
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
-ADMIN_IDS = []
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))  # Потоки для запросов к БД и соединения в пуле
+CLIENT_CACHE_SIZE = 10000  # Записей в кэше клиентов
+ORDERS_CACHE_SIZE = 64  # Дат в кэше заказов на дату
+ORDERS_CACHE_TTL = 60  # Секунд жизни записи в кэше заказов на дату
+STATS_CACHE_SIZE = 16  # Готовых CSV-отчётов /stats в кэше
+STATS_CACHE_TTL = 60  # Секунд жизни готового CSV-отчёта /stats
+TG_CONNECTION_POOL_SIZE = 256  # Keep-alive соединения с Bot API (как по умолчанию в PTB; рассылка админам идёт параллельно)
+TG_POOL_TIMEOUT = 5.0  # Секунд ожидания свободного соединения из пула (по умолчанию в PTB 1 с)
+ADMIN_IDS: Set[int] = set()
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID", "")
 if ADMIN_CHAT_ID:
     try:
-        ADMIN_IDS = [int(id.strip()) for id in ADMIN_CHAT_ID.split(",") if id.strip()]
+        ADMIN_IDS = {int(id.strip()) for id in ADMIN_CHAT_ID.split(",") if id.strip()}
     except ValueError as e:
-        logger.error(f"Ошибка парсинга ADMIN_CHAT_ID: {e}")
+        logger.error("Ошибка парсинга ADMIN_CHAT_ID: %s", e)
 
 # Состояния для ConversationHandler
 REGISTER_ORG, REGISTER_CONTACT, ENTER_QUANTITY = range(3)
@@ -67,6 +83,25 @@ PRODUCTS = [
 ]
 
 PRODUCTS_BY_TITLE = {p["title"]: p for p in PRODUCTS}
+PRODUCTS_BY_ID = {p["id"]: p for p in PRODUCTS}
+EMPTY_CART = {"items": {}, "order": ()}  # Заглушка для пользователей без корзины, только для чтения
+# Готовые результаты inline-меню с названием в нижнем регистре для поиска
+INLINE_PRODUCTS = [
+    (
+        p["title"].lower(),
+        InlineQueryResultArticle(
+            id=p["id"],
+            title=p["title"],
+            description=p["description"],
+            thumbnail_url=p["thumb_url"],
+            input_message_content=InputTextMessageContent(f"{p['title']}\n{p['description']}")
+        )
+    )
+    for p in PRODUCTS
+]
+INLINE_RESULTS_LIMIT = 50  # Больше Telegram в ответ на inline-запрос не принимает
+INLINE_CACHE_SIZE = 256  # Запросов в локальном кэше ответов inline-меню
+INLINE_CACHE_TIME = 300  # Секунд, которые Telegram кэширует ответ на inline-запрос
 
 # Интервалы доставки
 DELIVERY_TIME_INTERVALS = [
@@ -83,247 +118,657 @@ DELIVERY_TIME_INTERVALS = [
     "11:00 - 13:00"
 ]
 
+CANCEL_DEADLINE = timedelta(hours=6)  # Отмена заказа возможна не позднее чем за 6 часов до доставки
+
+# Статичные клавиатуры (не меняются за время работы бота)
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 Каталог", callback_data="catalog")],
+    [InlineKeyboardButton("📦 Мои заказы", callback_data="my_orders")],
+    [InlineKeyboardButton("ℹ️ О нас", callback_data="about")]
+])
+BACK_TO_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_menu")]])
+OPEN_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Открыть меню", switch_inline_query_current_chat="")]])
+MANAGER_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("👨‍💼 Связаться с менеджером", url="https://t.me/Krash_order_Bot")]])
+ORDER_PLACED_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ Отменить заказ", callback_data="cancel_last_order")],
+    [InlineKeyboardButton("👨‍💼 Связаться с менеджером", url="https://t.me/Krash_order_Bot")]
+])
+CART_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("◀️", callback_data="prev_item"),
+        InlineKeyboardButton("▶️", callback_data="next_item"),
+    ],
+    [
+        InlineKeyboardButton("❌ Удалить", callback_data="remove_item"),
+        InlineKeyboardButton("🚚 Доставка", callback_data="select_delivery_date")
+    ],
+    [
+        InlineKeyboardButton("➕ Добавить еще", switch_inline_query_current_chat=""),
+        InlineKeyboardButton("👨‍💼 Менеджер", url="https://t.me/kras_yulya")
+    ]
+])
+DELIVERY_TIMES_MARKUP = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton(interval, callback_data=f"delivery_time_{interval}") 
+         for interval in DELIVERY_TIME_INTERVALS[i:i+2]]
+        for i in range(0, len(DELIVERY_TIME_INTERVALS)-1, 2)  # Исключаем последний интервал
+    ] + [
+        # Последний интервал отдельной кнопкой внизу
+        [InlineKeyboardButton(DELIVERY_TIME_INTERVALS[-1], callback_data=f"delivery_time_{DELIVERY_TIME_INTERVALS[-1]}")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_dates")]
+    ]
+)
+
+# Формат CSV-отчёта /stats: дата, клиент, организация и 13 колонок товаров
+STATS_HEADER = (
+    "Клиент", "Организация",
+    "Классический", "Миндальный", "Заморозка/10шт", "Пан-о-шоколя",
+    "Ванильный", "Шоколадный", "Матча", "Мини",
+    "Улитка/Изюм", "Улитка/Мак", "Булка/Кардамон",
+    "Комбо1", "Комбо2"
+)
+
+# Пустые ячейки после названия периода в первой строке отчёта /stats
+STATS_TITLE_PADDING = ("",) * 14
+
+# Сводка /stats по товарам 1..13 считается в SQL: одна колонка на товар.
+# Текст запроса собирается один раз при импорте; параметры: (с датой?, начало, конец)
+STATS_QUERY = """
+    SELECT CASE WHEN %s THEN to_char(delivery_date, 'DD.MM') ELSE '' END AS day,
+           order_data->>'contact_person' AS contact,
+           order_data->>'organization' AS org,
+           {pivot}
+    FROM orders JOIN order_items USING (order_id)
+    WHERE delivery_date BETWEEN %s AND %s AND status = 'active'
+    GROUP BY delivery_date, user_id, contact, org
+    ORDER BY delivery_date, contact
+""".format(pivot=",\n           ".join(
+    f"COALESCE(SUM(quantity) FILTER (WHERE product_id = {pid}), 0) AS p{pid}"
+    for pid in range(1, 14)
+))
+
+# Аргумент /stats: DD.MM (день) или MM.YYYY (месяц)
+STATS_ARG_RE = re.compile(r'^(\d{1,2})\.(\d{2}|\d{4})$')
+
+# Аргумент /add_admin и /remove_admin: числовой ID (у групп отрицательный)
+USER_ID_RE = re.compile(r'^-?[0-9]+\Z')
+
+# Название организации и ФИО при регистрации: буквы, пробелы и дефисы
+NAME_RE = re.compile(r'^[А-Яа-яA-Za-z -]+\Z')
+NAME_MAX_LEN = 200
+
+def delivery_start(delivery_date: date, interval: str) -> datetime:
+    """Начало интервала доставки вида "6:30 - 8:30" в указанный день"""
+    hours, minutes = interval.split(" - ", 1)[0].split(":")
+    return datetime(delivery_date.year, delivery_date.month, delivery_date.day, int(hours), int(minutes))
+
 # Генерация дат доставки
-def generate_delivery_dates():
-    today = datetime.now()
+def generate_delivery_dates(today: date):
     dates = []
     date_keys = []
     
     for i in range(1, 8):
         delivery_date = today + timedelta(days=i)
         dates.append(delivery_date.strftime("%d.%m"))
-        date_keys.append(f"delivery_date_{delivery_date.strftime('%Y-%m-%d')}")
+        date_keys.append(f"delivery_date_{delivery_date.isoformat()}")
     
     return dates, date_keys
 
+# Объекты схемы, создаваемые в create_tables: если все они есть, DDL при старте пропускается.
+# Новая таблица или индекс в create_tables должны добавляться и сюда
+SCHEMA_OBJECTS = (
+    'clients',
+    'admins',
+    'orders',
+    'orders_delivery_date_status_idx',
+    'orders_user_id_created_at_active_idx',
+    'order_items',
+)
+
+# Сериализация order_data в jsonb: кириллица без \uXXXX-экранирования и без лишних пробелов
+JSONB_DUMPS = partial(json.dumps, ensure_ascii=False, separators=(',', ':'))
+
+# Частые запросы на чтение готовятся один раз на каждом соединении пула
+PREPARED_STATEMENTS = """
+    PREPARE get_client_ps (bigint) AS
+        SELECT organization, contact_person FROM clients WHERE user_id = $1;
+    PREPARE get_active_order_ps (bigint) AS
+        SELECT order_id, order_data, delivery_date, delivery_time
+        FROM orders
+        WHERE user_id = $1 AND status = 'active'
+        ORDER BY created_at DESC
+        LIMIT 1;
+    PREPARE get_order_ps (int) AS
+        SELECT order_id, user_id, order_data, delivery_date, delivery_time, status
+        FROM orders
+        WHERE order_id = $1;
+    PREPARE get_orders_for_date_ps (date) AS
+        SELECT order_id, user_id, order_data, delivery_date, delivery_time
+        FROM orders
+        WHERE delivery_date = $1 AND status = 'active';
+"""
+
+# Строки выборок заказов (порядок полей совпадает с порядком колонок в запросах)
+Order = namedtuple('Order', 'order_id user_id order_data delivery_date delivery_time status')
+ActiveOrder = namedtuple('ActiveOrder', 'order_id order_data delivery_date delivery_time')
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш ограниченного размера с необязательным TTL записей"""
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            stored_at, value = item
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Соединение, помнящее, выполнены ли на нём PREPARED_STATEMENTS"""
+    prepared = False
+
 class Database:
     def __init__(self):
         try:
-            self.conn = psycopg2.connect(DATABASE_URL)
-            self.cursor = self.conn.cursor(cursor_factory=extras.DictCursor)
+            # Пул фиксированного размера: соединения (и подготовленные на них запросы)
+            # живут всё время работы бота, по одному на поток BotHandlers._db_executor
+            self.pool = pool.ThreadedConnectionPool(
+                DB_POOL_SIZE, DB_POOL_SIZE, DATABASE_URL,
+                connection_factory=PreparedConnection,
+                keepalives=1, keepalives_idle=60
+            )
+            self._client_cache = LRUCache(maxsize=CLIENT_CACHE_SIZE)
+            self._orders_by_date = LRUCache(maxsize=ORDERS_CACHE_SIZE, ttl=ORDERS_CACHE_TTL)
+            # Растёт при каждом изменении заказов и входит в ключ кэша отчётов /stats
+            self._orders_versions = count(1)
+            self.orders_version = 0
+            self._orders_lock = threading.Lock()  # Сброс кэша заказов и запись в него не пересекаются
             self.create_tables()
+            self.warm_client_cache()
             logger.info("Connected to PostgreSQL database")
         except Exception as e:
-            logger.error(f"Error connecting to database: {e}")
+            logger.error("Error connecting to database: %s", e)
             raise
     
+    @contextmanager
+    def _conn(self, prepare: bool = True):
+        """Соединение из пула; возвращается в пул даже при исключении"""
+        conn = self.pool.getconn()
+        try:
+            if prepare and not conn.prepared:
+                with conn.cursor() as cursor:
+                    cursor.execute(PREPARED_STATEMENTS)
+                conn.commit()
+                conn.prepared = True
+            yield conn
+        finally:
+            self.pool.putconn(conn)
+    
+    @contextmanager
+    def _conn_commit(self, prepare: bool = True):
+        """Как _conn, но с commit при успехе и rollback при исключении"""
+        with self._conn(prepare) as conn:
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    
+    @contextmanager
+    def _conn_autocommit(self):
+        """Как _conn, но в autocommit: для записей из одного оператора без BEGIN/COMMIT"""
+        with self._conn() as conn:
+            conn.autocommit = True
+            try:
+                yield conn
+            finally:
+                conn.autocommit = False
+    
     def create_tables(self):
+        # prepare=False: подготовка запросов требует уже созданных таблиц
         try:
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS clients (
-                    user_id BIGINT PRIMARY KEY,
-                    organization TEXT NOT NULL,
-                    contact_person TEXT NOT NULL
-                );
-                CREATE TABLE IF NOT EXISTS admins (
-                    user_id BIGINT PRIMARY KEY
-                );
-                CREATE TABLE IF NOT EXISTS orders (
-                    order_id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    order_data JSONB,
-                    delivery_date TEXT,
-                    delivery_time TEXT,
-                    status TEXT DEFAULT 'active',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            self.conn.commit()
+            with self._conn_commit(prepare=False) as conn, conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT bool_and(to_regclass(name) IS NOT NULL) FROM unnest(%s) AS name",
+                    (list(SCHEMA_OBJECTS),)
+                )
+                if cursor.fetchone()[0]:
+                    logger.info("Database schema is up to date")
+                    return
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS clients (
+                        user_id BIGINT PRIMARY KEY,
+                        organization TEXT NOT NULL,
+                        contact_person TEXT NOT NULL
+                    );
+                    CREATE TABLE IF NOT EXISTS admins (
+                        user_id BIGINT PRIMARY KEY
+                    );
+                    CREATE TABLE IF NOT EXISTS orders (
+                        order_id SERIAL PRIMARY KEY,
+                        user_id BIGINT,
+                        order_data JSONB,
+                        delivery_date DATE,
+                        delivery_time TEXT,
+                        status TEXT DEFAULT 'active',
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                    -- Миграция старых баз, где дата доставки хранилась строкой YYYY-MM-DD
+                    DO $$
+                    BEGIN
+                        IF (SELECT data_type FROM information_schema.columns
+                            WHERE table_schema = current_schema() AND table_name = 'orders'
+                              AND column_name = 'delivery_date') = 'text' THEN
+                            ALTER TABLE orders ALTER COLUMN delivery_date TYPE DATE USING delivery_date::date;
+                        END IF;
+                    END $$;
+                    CREATE INDEX IF NOT EXISTS orders_delivery_date_status_idx
+                        ON orders (delivery_date) WHERE status = 'active';
+                    CREATE INDEX IF NOT EXISTS orders_user_id_created_at_active_idx
+                        ON orders (user_id, created_at DESC) WHERE status = 'active';
+                    -- Позиции заказа отдельными строками: отчёты не разбирают order_data
+                    CREATE TABLE IF NOT EXISTS order_items (
+                        order_id INT REFERENCES orders ON DELETE CASCADE,
+                        product_id INT,
+                        quantity INT NOT NULL,
+                        PRIMARY KEY (order_id, product_id)
+                    );
+                    -- Перенос позиций заказов, сохранённых до появления order_items
+                    INSERT INTO order_items (order_id, product_id, quantity)
+                    SELECT order_id, (item->'product'->>'id')::int, SUM((item->>'quantity')::int)
+                    FROM orders, LATERAL jsonb_array_elements(order_data->'items') item
+                    GROUP BY 1, 2
+                    ON CONFLICT DO NOTHING;
+                """)
             logger.info("Database tables initialized successfully")
         except Exception as e:
-            logger.error(f"Error creating tables: {e}")
-            self.conn.rollback()
+            logger.error("Error creating tables: %s", e)
             raise
     
+    def get_cached_client(self, user_id: int) -> Optional[Tuple[str, str]]:
+        """Клиент из кэша без обращения к БД (None, если в кэше его нет)"""
+        return self._client_cache.get(user_id)
+    
     def get_client(self, user_id: int) -> Tuple[Optional[str], Optional[str]]:
+        cached = self._client_cache.get(user_id)
+        if cached is not None:
+            return cached
+        
         try:
-            self.cursor.execute("SELECT organization, contact_person FROM clients WHERE user_id = %s", (user_id,))
-            result = self.cursor.fetchone()
-            return (result['organization'], result['contact_person']) if result else (None, None)
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute("EXECUTE get_client_ps (%s)", (user_id,))
+                result = cursor.fetchone()
         except Exception as e:
-            logger.error(f"Error fetching client {user_id}: {e}")
+            logger.error("Error fetching client %s: %s", user_id, e)
+            return None, None
+        if not result:
             return None, None
+        self._client_cache.set(user_id, result)  # (organization, contact_person)
+        return result
     
     def add_client(self, user_id: int, organization: str, contact_person: str):
         try:
-            self.cursor.execute(
-                "INSERT INTO clients (user_id, organization, contact_person) VALUES (%s, %s, %s)",
-                (user_id, organization, contact_person)
-            )
-            self.conn.commit()
-            logger.info(f"Client {user_id} added: {organization}, {contact_person}")
+            with self._conn_autocommit() as conn, conn.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO clients (user_id, organization, contact_person) VALUES (%s, %s, %s)",
+                    (user_id, organization, contact_person)
+                )
+        except Exception as e:
+            logger.error("Error adding client %s: %s", user_id, e)
+            self._client_cache.pop(user_id)
+            return
+        self._client_cache.set(user_id, (organization, contact_person))
+        logger.info("Client %s added: %s, %s", user_id, organization, contact_person)
+    
+    def add_clients_bulk(self, clients: List[Tuple[int, str, str]]) -> int:
+        """Массовая вставка клиентов (user_id, организация, контакт) одним запросом"""
+        try:
+            with self._conn_commit() as conn, conn.cursor() as cursor:
+                inserted = extras.execute_values(
+                    cursor,
+                    """
+                    INSERT INTO clients (user_id, organization, contact_person) VALUES %s
+                    ON CONFLICT (user_id) DO NOTHING
+                    RETURNING user_id, organization, contact_person
+                    """,
+                    clients,
+                    page_size=500,
+                    fetch=True
+                )
+        except Exception as e:
+            logger.error("Error adding %s clients: %s", len(clients), e)
+            raise
+        
+        for user_id, organization, contact_person in inserted:
+            self._client_cache.set(user_id, (organization, contact_person))
+        logger.info("Bulk-added %s of %s clients", len(inserted), len(clients))
+        return len(inserted)
+    
+    def add_clients_copy(self, clients: List[Tuple[int, str, str]]) -> int:
+        """Вариант add_clients_bulk через COPY для больших импортов (>10k строк)"""
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(clients)
+        buffer.seek(0)
+        
+        try:
+            with self._conn_commit() as conn, conn.cursor() as cursor:
+                # COPY не поддерживает ON CONFLICT, поэтому грузим через временную таблицу
+                cursor.execute("CREATE TEMP TABLE clients_import (LIKE clients) ON COMMIT DROP")
+                cursor.copy_expert("COPY clients_import FROM STDIN WITH CSV", buffer)
+                cursor.execute("""
+                    INSERT INTO clients SELECT * FROM clients_import
+                    ON CONFLICT (user_id) DO NOTHING
+                    RETURNING user_id, organization, contact_person
+                """)
+                inserted = cursor.fetchall()
         except Exception as e:
-            logger.error(f"Error adding client {user_id}: {e}")
-            self.conn.rollback()
+            logger.error("Error copying %s clients: %s", len(clients), e)
+            raise
+        
+        for user_id, organization, contact_person in inserted:
+            self._client_cache.set(user_id, (organization, contact_person))
+        logger.info("Copied %s of %s clients", len(inserted), len(clients))
+        return len(inserted)
     
     def get_all_clients(self) -> Dict[int, Tuple[str, str]]:
         try:
-            self.cursor.execute("SELECT user_id, organization, contact_person FROM clients")
-            return {row['user_id']: (row['organization'], row['contact_person']) for row in self.cursor.fetchall()}
+            # Серверный (именованный) курсор: строки приходят пачками по itersize, без fetchall
+            with self._conn() as conn, conn.cursor(name='clients_scan') as cursor:
+                cursor.itersize = 2000
+                cursor.execute("SELECT user_id, organization, contact_person FROM clients")
+                return {user_id: (organization, contact_person) for user_id, organization, contact_person in cursor}
         except Exception as e:
-            logger.error(f"Error fetching all clients: {e}")
+            logger.error("Error fetching all clients: %s", e)
             return {}
     
-    def save_order(self, user_id: int, order_data: Dict[str, Any], delivery_date: str, delivery_time: str) -> int:
+    def warm_client_cache(self):
+        clients = self.get_all_clients()
+        for user_id, client in clients.items():
+            self._client_cache.set(user_id, client)
+        logger.info("Client cache warmed with %s clients", len(clients))
+    
+    @staticmethod
+    def _order_item_rows(order_id: int, order_data: Dict[str, Any]) -> List[Tuple[int, int, int]]:
+        """Строки order_items (order_id, product_id, quantity) из позиций корзины"""
+        quantities: Dict[int, int] = defaultdict(int)
+        for item in order_data["items"]:
+            quantities[int(item["product"]["id"])] += item["quantity"]
+        return [(order_id, product_id, quantity) for product_id, quantity in quantities.items()]
+    
+    def _orders_changed(self, *delivery_dates: date):
+        """Сбрасывает кэш заказов на эти даты и делает устаревшими закэшированные отчёты"""
+        with self._orders_lock:
+            for delivery_date in delivery_dates:
+                self._orders_by_date.pop(delivery_date)
+            self.orders_version = next(self._orders_versions)
+    
+    def save_order(self, user_id: int, order_data: Dict[str, Any], delivery_date: date, delivery_time: str) -> int:
+        """Сохраняет заказ без ожидания fsync WAL: при сбое сервера БД последние
+        заказы могут потеряться, но клиент всегда может оформить заказ заново"""
         try:
-            self.cursor.execute('''
-                INSERT INTO orders (user_id, order_data, delivery_date, delivery_time)
-                VALUES (%s, %s, %s, %s)
-                RETURNING order_id
-            ''', (user_id, json.dumps(order_data), delivery_date, delivery_time))
-            order_id = self.cursor.fetchone()['order_id']
-            self.conn.commit()
-            return order_id
+            with self._conn_commit() as conn, conn.cursor() as cursor:
+                cursor.execute("SET LOCAL synchronous_commit = off")
+                cursor.execute('''
+                    INSERT INTO orders (user_id, order_data, delivery_date, delivery_time)
+                    VALUES (%s, %s, %s, %s)
+                    RETURNING order_id
+                ''', (user_id, extras.Json(order_data, dumps=JSONB_DUMPS), delivery_date, delivery_time))
+                order_id = cursor.fetchone()[0]
+                extras.execute_values(
+                    cursor,
+                    "INSERT INTO order_items (order_id, product_id, quantity) VALUES %s",
+                    self._order_item_rows(order_id, order_data)
+                )
         except Exception as e:
-            logger.error(f"Error saving order for user {user_id}: {e}")
-            self.conn.rollback()
+            logger.error("Error saving order for user %s: %s", user_id, e)
             raise
+        self._orders_changed(delivery_date)
+        return order_id
     
-    def cancel_order(self, order_id: int) -> bool:
+    def save_orders(self, orders: List[Tuple[int, Dict[str, Any], date, str]]) -> List[int]:
+        """Массовое сохранение заказов (user_id, order_data, дата, время); порядок id не совпадает с входным"""
         try:
-            self.cursor.execute('''
-                UPDATE orders 
-                SET status = 'cancelled' 
-                WHERE order_id = %s AND status = 'active'
-            ''', (order_id,))
-            rows_affected = self.cursor.rowcount
-            self.conn.commit()
-            return rows_affected > 0
+            with self._conn_commit() as conn, conn.cursor() as cursor:
+                cursor.execute("SET LOCAL synchronous_commit = off")
+                rows = extras.execute_values(
+                    cursor,
+                    """
+                    INSERT INTO orders (user_id, order_data, delivery_date, delivery_time) VALUES %s
+                    RETURNING order_id
+                    """,
+                    [
+                        (user_id, extras.Json(order_data, dumps=JSONB_DUMPS), delivery_date, delivery_time)
+                        for user_id, order_data, delivery_date, delivery_time in orders
+                    ],
+                    page_size=200,
+                    fetch=True
+                )
+                order_ids = [order_id for order_id, in rows]
+                # RETURNING не обязан сохранять порядок VALUES, поэтому позиции берутся
+                # из только что вставленных строк, а не сопоставляются с входным списком
+                cursor.execute("""
+                    INSERT INTO order_items (order_id, product_id, quantity)
+                    SELECT order_id, (item->'product'->>'id')::int, SUM((item->>'quantity')::int)
+                    FROM orders, LATERAL jsonb_array_elements(order_data->'items') item
+                    WHERE order_id = ANY(%s)
+                    GROUP BY 1, 2
+                """, (order_ids,))
         except Exception as e:
-            logger.error(f"Error cancelling order {order_id}: {e}")
-            self.conn.rollback()
-            return False
+            logger.error("Error saving %s orders: %s", len(orders), e)
+            raise
+        
+        self._orders_changed(*{order[2] for order in orders})
+        return order_ids
     
-    def get_active_order(self, user_id: int) -> Optional[Dict[str, Any]]:
+    def cancel_order(self, order_id: int) -> Optional[Order]:
+        """Отменяет активный заказ и возвращает его данные (None, если отменять нечего)"""
         try:
-            self.cursor.execute('''
-                SELECT order_id, order_data, delivery_date, delivery_time 
-                FROM orders 
-                WHERE user_id = %s AND status = 'active'
-                ORDER BY created_at DESC 
-                LIMIT 1
-            ''', (user_id,))
-            result = self.cursor.fetchone()
-            if result:
-                return {
-                    'order_id': result['order_id'],
-                    'order_data': json.loads(result['order_data']),
-                    'delivery_date': result['delivery_date'],
-                    'delivery_time': result['delivery_time']
-                }
-            return None
+            with self._conn_autocommit() as conn, conn.cursor() as cursor:
+                cursor.execute('''
+                    UPDATE orders 
+                    SET status = 'cancelled' 
+                    WHERE order_id = %s AND status = 'active'
+                    RETURNING order_id, user_id, order_data, delivery_date, delivery_time, status
+                ''', (order_id,))
+                result = cursor.fetchone()
         except Exception as e:
-            logger.error(f"Error getting active order for user {user_id}: {e}")
+            logger.error("Error cancelling order %s: %s", order_id, e)
             return None
-        
-    def get_order(self, order_id: int) -> Optional[Dict[str, Any]]:
+        if not result:
+            return None
+        order = Order._make(result)
+        self._orders_changed(order.delivery_date)
+        return order
+    
+    def get_active_order(self, user_id: int) -> Optional[ActiveOrder]:
         try:
-            self.cursor.execute('''
-                SELECT order_id, user_id, order_data, delivery_date, delivery_time, status 
-                FROM orders 
-                WHERE order_id = %s
-            ''', (order_id,))
-            result = self.cursor.fetchone()
-            if result:
-                return {
-                    'order_id': result['order_id'],
-                    'user_id': result['user_id'],
-                    'order_data': result['order_data'],  # Уже dict благодаря DictCursor
-                    'delivery_date': result['delivery_date'],
-                    'delivery_time': result['delivery_time'],
-                    'status': result['status']
-                }
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute("EXECUTE get_active_order_ps (%s)", (user_id,))
+                result = cursor.fetchone()
+        except Exception as e:
+            logger.error("Error getting active order for user %s: %s", user_id, e)
             return None
+        # jsonb в order_data уже декодирован psycopg2
+        return ActiveOrder._make(result) if result else None
+    
+    def get_order(self, order_id: int) -> Optional[Order]:
+        try:
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute("EXECUTE get_order_ps (%s)", (order_id,))
+                result = cursor.fetchone()
         except Exception as e:
-            logger.error(f"Error getting order {order_id}: {e}")
+            logger.error("Error getting order %s: %s", order_id, e)
             return None
-        
-    def get_orders_for_date(self, date_str: str) -> list:
+        return Order._make(result) if result else None
+    
+    def get_orders_for_date(self, delivery_date: date) -> tuple:
+        """Активные заказы на дату; кортеж общий для всех вызывающих из кэша"""
+        cached = self._orders_by_date.get(delivery_date)
+        if cached is not None:
+            return cached
+        
+        # Версия читается до запроса: если заказы изменились, пока он шёл, результат не кэшируется
+        version = self.orders_version
         try:
-            self.cursor.execute("""
-                SELECT order_id, user_id, order_data, delivery_date, delivery_time 
-                FROM orders 
-                WHERE delivery_date = %s AND status = 'active'
-            """, (date_str,))
-            return self.cursor.fetchall()
+            with self._conn() as conn, conn.cursor(cursor_factory=extras.NamedTupleCursor) as cursor:
+                cursor.execute("EXECUTE get_orders_for_date_ps (%s)", (delivery_date,))
+                orders = tuple(cursor.fetchall())
         except Exception as e:
-            logger.error(f"Error fetching orders for date {date_str}: {e}")
-            return []
+            logger.error("Error fetching orders for date %s: %s", delivery_date, e)
+            return ()
+        with self._orders_lock:
+            if self.orders_version == version:
+                self._orders_by_date.set(delivery_date, orders)
+        return orders
+    
+    def iter_stats_rows(self, start_date: date, end_date: date, with_day: bool):
+        """Готовые строки CSV (ДД.ММ или '', контакт, организация, p1..p13) за период; ошибки пробрасываются"""
+        # Серверный курсор: в памяти не больше itersize строк, пока пишется CSV
+        with self._conn() as conn, conn.cursor(name='stats_export') as cursor:
+            cursor.itersize = 2000
+            cursor.execute(STATS_QUERY, (with_day, start_date, end_date))
+            yield from cursor
     
     def close(self):
-        self.cursor.close()
-        self.conn.close()
+        self.pool.closeall()
         logger.info("Database connection closed")
 
 class BotHandlers:
     def __init__(self):
         self.db = Database()
-        self.user_carts: Dict[int, Dict[str, Any]] = {}
+        self._db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+        self.user_carts: Dict[int, Dict[str, Any]] = {}  # {"items": {id товара: количество}, "order": [id в порядке добавления]}
         self.current_editing: Dict[int, int] = {}
         self.selected_dates: Dict[int, str] = {}
         self.last_orders: Dict[int, Dict[str, Any]] = {}
         self.pending_product: Dict[int, Dict[str, Any]] = {}  # Хранит продукт, для которого вводится количество
+        self._inline_cache = LRUCache(maxsize=INLINE_CACHE_SIZE)  # Текст запроса -> готовые результаты
+        # (версия заказов, период, режим) -> байты CSV; запись заказа меняет версию
+        self._stats_cache = LRUCache(maxsize=STATS_CACHE_SIZE, ttl=STATS_CACHE_TTL)
+        self._dates_markup_day: Optional[date] = None  # День, на который построена клавиатура дат
+        self._dates_markup: Optional[InlineKeyboardMarkup] = None
+
+        # Таблицы диспетчеризации callback-запросов: обработчики вида (update, context)
+        self._cb_map = {
+            "prev_item": self._cb_prev_item,
+            "next_item": self._cb_next_item,
+            "remove_item": self._cb_remove_item,
+            "select_delivery_date": self.show_delivery_dates,
+            "back_to_cart": self._cb_back_to_cart,
+            "back_to_dates": self.show_delivery_dates,
+            "cancel_last_order": self.cancel_last_order,
+            "my_orders": self.show_active_orders,
+            "catalog": self._cb_catalog,
+            "about": self._cb_about,
+            "back_to_menu": self._show_main_menu,
+        }
+        self._cb_prefix = (
+            ("delivery_date_", self._cb_pick_date),
+            ("delivery_time_", self.process_delivery_time),
+        )
+
+    async def _db(self, fn, *args, **kwargs):
+        """Выполняет блокирующий вызов БД в пуле потоков, не занимая цикл событий"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._db_executor, partial(fn, *args, **kwargs))
+    
+    async def _get_client(self, user_id: int) -> Tuple[Optional[str], Optional[str]]:
+        """(организация, контакт) клиента; попадание в кэш обходится без пула потоков"""
+        client = self.db.get_cached_client(user_id)
+        if client is not None:
+            return client
+        return await self._db(self.db.get_client, user_id)
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Обработчик команды /start"""
         try:
+            msg = update.effective_message
             user = update.effective_user
-            logger.info(f"Processing /start for user {user.id} in chat {update.message.chat.type}")
+            logger.info("Processing /start for user %s in chat %s", user.id, msg.chat.type)
             
-            if update.message.chat.type != 'private':
-                logger.info(f"User {user.id} attempted registration in non-private chat")
-                await update.message.reply_text("Регистрация доступна только в приватном чате с ботом.")
+            if msg.chat.type != 'private':
+                logger.info("User %s attempted registration in non-private chat", user.id)
+                await msg.reply_text("Регистрация доступна только в приватном чате с ботом.")
                 return ConversationHandler.END
             
             context.user_data.clear()
-            logger.info(f"Cleared user_data for user {user.id}")
+            logger.info("Cleared user_data for user %s", user.id)
             
-            organization, contact_person = self.db.get_client(user.id)
+            organization, contact_person = await self._get_client(user.id)
             if organization and contact_person:
-                logger.info(f"User {user.id} already registered: {organization}, {contact_person}")
-                await update.message.reply_text(
+                logger.info("User %s already registered: %s, %s", user.id, organization, contact_person)
+                await msg.reply_text(
                     "Вы уже зарегистрированы. Меню товаров:",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("Открыть меню", switch_inline_query_current_chat="")]
-                    ])
+                    reply_markup=OPEN_MENU_MARKUP
                 )
                 return ConversationHandler.END
             
-            logger.info(f"User {user.id} not registered, entering REGISTER_ORG state")
-            await update.message.reply_text(
+            logger.info("User %s not registered, entering REGISTER_ORG state", user.id)
+            await msg.reply_text(
                 "Добро пожаловать! Для начала работы необходимо зарегистрироваться. "
                 "Пожалуйста, введите название вашей организации:"
             )
             return REGISTER_ORG
         except Exception as e:
-            logger.error(f"Error in start for user {user.id}: {str(e)}", exc_info=True)
-            await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте позже.")
+            logger.error("Error in start for user %s: %s", user.id, e, exc_info=True)
+            await msg.reply_text("Произошла ошибка. Пожалуйста, попробуйте позже.")
             return ConversationHandler.END
     
     async def register_org(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Обработчик ввода организации"""
         try:
-            user_id = update.message.from_user.id
-            org = update.message.text.strip()
-            logger.info(f"register_org called for user {user_id} with text '{org}'")
+            msg = update.effective_message
+            user_id = update.effective_user.id
+            org = msg.text.strip()
+            logger.info("register_org called for user %s with text '%s'", user_id, org)
             
             if not org:
-                logger.info(f"Organization name is empty for user {user_id}")
-                await update.message.reply_text("Название организации не может быть пустым. Попробуйте снова:")
+                logger.info("Organization name is empty for user %s", user_id)
+                await msg.reply_text("Название организации не может быть пустым. Попробуйте снова:")
+                return REGISTER_ORG
+            
+            if len(org) > NAME_MAX_LEN:
+                await msg.reply_text(f"Название организации не должно быть длиннее {NAME_MAX_LEN} символов. Попробуйте снова:")
                 return REGISTER_ORG
             
-            if not re.match(r'^[А-Яа-яA-Za-z\s-]+$', org):
-                logger.info(f"Organization name '{org}' does not match regex for user {user_id}")
-                await update.message.reply_text("Название организации должно содержать только буквы, пробелы или дефисы. Попробуйте снова:")
+            if not NAME_RE.match(org):
+                logger.info("Organization name '%s' does not match regex for user %s", org, user_id)
+                await msg.reply_text("Название организации должно содержать только буквы, пробелы или дефисы. Попробуйте снова:")
                 return REGISTER_ORG
             
             context.user_data['organization'] = org
-            logger.info(f"Organization '{org}' saved for user {user_id}, moving to REGISTER_CONTACT")
-            await update.message.reply_text("Теперь введите ваше контактное лицо (ФИО):")
+            logger.info("Organization '%s' saved for user %s, moving to REGISTER_CONTACT", org, user_id)
+            await msg.reply_text("Теперь введите ваше контактное лицо (ФИО):")
             return REGISTER_CONTACT
         except Exception as e:
-            logger.error(f"Error in register_org for user {user_id}: {str(e)}", exc_info=True)
-            await update.message.reply_text(
+            logger.error("Error in register_org for user %s: %s", user_id, e, exc_info=True)
+            await msg.reply_text(
                 "Произошла ошибка при обработке названия организации. "
                 "Пожалуйста, попробуйте снова или обратитесь в поддержке."
             )
@@ -332,86 +777,91 @@ class BotHandlers:
     async def register_contact(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Обработчик ввода контактного лица"""
         try:
-            user_id = update.message.from_user.id
-            contact = update.message.text.strip()
-            logger.info(f"register_contact called for user {user_id} with text '{contact}'")
+            msg = update.effective_message
+            user_id = update.effective_user.id
+            contact = msg.text.strip()
+            logger.info("register_contact called for user %s with text '%s'", user_id, contact)
             
             if not contact:
-                logger.info(f"Contact person is empty for user {user_id}")
-                await update.message.reply_text("ФИО не может быть пустым. Попробуйте снова:")
+                logger.info("Contact person is empty for user %s", user_id)
+                await msg.reply_text("ФИО не может быть пустым. Попробуйте снова:")
                 return REGISTER_CONTACT
             
-            if not re.match(r'^[А-Яа-яA-Za-z\s-]+$', contact):
-                logger.info(f"Contact person '{contact}' does not match regex for user {user_id}")
-                await update.message.reply_text("ФИО должно содержать только буквы, пробелы или дефисы. Попробуйте снова:")
+            if len(contact) > NAME_MAX_LEN:
+                await msg.reply_text(f"ФИО не должно быть длиннее {NAME_MAX_LEN} символов. Попробуйте снова:")
+                return REGISTER_CONTACT
+            
+            if not NAME_RE.match(contact):
+                logger.info("Contact person '%s' does not match regex for user %s", contact, user_id)
+                await msg.reply_text("ФИО должно содержать только буквы, пробелы или дефисы. Попробуйте снова:")
                 return REGISTER_CONTACT
             
             organization = context.user_data.get('organization')
             if not organization:
-                logger.error(f"No organization found in user_data for user {user_id}")
-                await update.message.reply_text("Ошибка: данные организации потеряны. Начните заново с /start.")
+                logger.error("No organization found in user_data for user %s", user_id)
+                await msg.reply_text("Ошибка: данные организации потеряны. Начните заново с /start.")
                 return ConversationHandler.END
             
-            self.db.add_client(user_id, organization, contact)
-            logger.info(f"Registration completed for user {user_id}: {organization}, {contact}")
-            await update.message.reply_text(
+            await self._db(self.db.add_client, user_id, organization, contact)
+            logger.info("Registration completed for user %s: %s, %s", user_id, organization, contact)
+            await msg.reply_text(
                 "Регистрация завершена! Теперь вы можете заказывать продукты.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("Открыть меню", switch_inline_query_current_chat="")]
-                ])
+                reply_markup=OPEN_MENU_MARKUP
             )
             context.user_data.clear()
             return ConversationHandler.END
         except Exception as e:
-            logger.error(f"Error in register_contact for user {user_id}: {str(e)}", exc_info=True)
-            await update.message.reply_text(
+            logger.error("Error in register_contact for user %s: %s", user_id, e, exc_info=True)
+            await msg.reply_text(
                 "Произошла ошибка при обработке ФИО. Пожалуйста, попробуйте снова или обратитесь в поддержку."
             )
             return REGISTER_CONTACT
     
     async def cancel_registration(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Обработчик отмены регистрации"""
-        user_id = update.message.from_user.id
-        logger.info(f"User {user_id} cancelled registration")
+        msg = update.effective_message
+        user_id = update.effective_user.id
+        logger.info("User %s cancelled registration", user_id)
         context.user_data.clear()
         self.pending_product.pop(user_id, None)
-        await update.message.reply_text("Регистрация отменена. Начните заново с /start.")
+        await msg.reply_text("Регистрация отменена. Начните заново с /start.")
         return ConversationHandler.END
     
     async def enter_quantity(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Обработчик ввода количества товара"""
-        user_id = update.message.from_user.id
-        quantity_text = update.message.text.strip()
-        logger.info(f"enter_quantity called for user {user_id} with text '{quantity_text}'")
+        msg = update.effective_message
+        user_id = update.effective_user.id
+        quantity_text = msg.text.strip()
+        logger.info("enter_quantity called for user %s with text '%s'", user_id, quantity_text)
         
         try:
             quantity = int(quantity_text)
             if quantity <= 0:
-                await update.message.reply_text("Количество должно быть больше нуля. Пожалуйста, введите корректное количество:")
+                await msg.reply_text("Количество должно быть больше нуля. Пожалуйста, введите корректное количество:")
                 return ENTER_QUANTITY
         except ValueError:
-            logger.info(f"Invalid quantity input '{quantity_text}' for user {user_id}")
-            await update.message.reply_text("Пожалуйста, введите число. Попробуйте снова:")
+            logger.info("Invalid quantity input '%s' for user %s", quantity_text, user_id)
+            await msg.reply_text("Пожалуйста, введите число. Попробуйте снова:")
             return ENTER_QUANTITY
         
         if user_id not in self.pending_product:
-            logger.error(f"No pending product for user {user_id}")
-            await update.message.reply_text("Ошибка: товар не выбран. Начните заново, выбрав товар из меню.")
+            logger.error("No pending product for user %s", user_id)
+            await msg.reply_text("Ошибка: товар не выбран. Начните заново, выбрав товар из меню.")
             return ConversationHandler.END
         
         product = self.pending_product[user_id]
         if user_id not in self.user_carts:
-            self.user_carts[user_id] = {"items": []}
+            self.user_carts[user_id] = {"items": {}, "order": []}
         
-        cart = self.user_carts[user_id]["items"]
-        for item in cart:
-            if item["product"]["id"] == product["id"]:
-                item["quantity"] += quantity
-                break
+        cart = self.user_carts[user_id]
+        product_id = product["id"]
+        if product_id in cart["items"]:
+            cart["items"][product_id] += quantity
         else:
-            cart.append({"product": product, "quantity": quantity})
+            cart["items"][product_id] = quantity
+            cart["order"].append(product_id)
         
-        self.current_editing[user_id] = len(cart) - 1
+        self.current_editing[user_id] = len(cart["order"]) - 1
         self.pending_product.pop(user_id, None)
         
         await self.show_cart(update, context, user_id)
@@ -419,76 +869,71 @@ class BotHandlers:
     
     async def check_client_info(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /info"""
-        user_id = update.message.from_user.id
-        organization, contact_person = self.db.get_client(user_id)
+        msg = update.effective_message
+        user_id = update.effective_user.id
+        organization, contact_person = await self._get_client(user_id)
         if organization and contact_person:
-            await update.message.reply_text(
+            await msg.reply_text(
                 f"Ваши данные:\nОрганизация: {organization}\nКонтактное лицо: {contact_person}"
             )
         else:
-            await update.message.reply_text("Вы не зарегистрированы. Пожалуйста, используйте /start для регистрации.")
+            await msg.reply_text("Вы не зарегистрированы. Пожалуйста, используйте /start для регистрации.")
     
     async def inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик inline-запросов для меню продуктов"""
-        query = update.inline_query.query
-        results = []
-        
-        for product in PRODUCTS:
-            if query.lower() in product["title"].lower():
-                results.append(
-                    InlineQueryResultArticle(
-                        id=product["id"],
-                        title=product["title"],
-                        description=product["description"],
-                        thumbnail_url=product["thumb_url"],
-                        input_message_content=InputTextMessageContent(
-                            f"{product['title']}\n{product['description']}"
-                        )
-                    )
-                )
+        query = update.inline_query.query.lower()
+        results = self._inline_cache.get(query)
+        
+        if results is None:
+            results = [article for title_lc, article in INLINE_PRODUCTS if query in title_lc][:INLINE_RESULTS_LIMIT]
+            self._inline_cache.set(query, results)
         
-        await update.inline_query.answer(results)
+        # Каталог общий для всех пользователей, поэтому ответ можно кэшировать на стороне Telegram
+        await update.inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False)
     
     async def handle_product_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Обработчик сообщений с товарами"""
-        user_id = update.message.from_user.id
-        logger.info(f"handle_product_message called for user {user_id} with text '{update.message.text}' in chat {update.message.chat.type}")
+        msg = update.effective_message
+        user_id = update.effective_user.id
+        logger.info("handle_product_message called for user %s with text '%s' in chat %s", user_id, msg.text, msg.chat.type)
+        
+        # Сначала дешёвая проверка товара: на посторонний текст отвечаем без обращения к клиентам
+        message_text = msg.text.strip()
+        first_line = message_text.split('\n', 1)[0].strip()
+        product = PRODUCTS_BY_TITLE.get(first_line)
+        if not product:
+            await msg.reply_text("Такой продукт не найден. Попробуйте снова.")
+            return ConversationHandler.END
         
         # Проверка регистрации
-        organization, contact_person = self.db.get_client(user_id)
+        organization, contact_person = await self._get_client(user_id)
         if not organization:
-            logger.info(f"User {user_id} is not registered, ignoring product message")
-            await update.message.reply_text("Пожалуйста, завершите регистрацию с помощью команды /start")
+            logger.info("User %s is not registered, ignoring product message", user_id)
+            await msg.reply_text("Пожалуйста, завершите регистрацию с помощью команды /start")
             return ConversationHandler.END
         
-        message_text = update.message.text.strip()
-        first_line = message_text.split('\n', 1)[0].strip()
-        
-        if (product := PRODUCTS_BY_TITLE.get(first_line)):
-            self.pending_product[user_id] = product
-            await update.message.reply_text(f"Вы выбрали: {product['title']}. Введите количество:")
-            return ENTER_QUANTITY
-        else:
-            await update.message.reply_text("Такой продукт не найден. Попробуйте снова.")
-            return ConversationHandler.END
+        self.pending_product[user_id] = product
+        await msg.reply_text(f"Вы выбрали: {product['title']}. Введите количество:")
+        return ENTER_QUANTITY
     
     async def show_cart(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, edit_message: bool = False):
         """Показывает корзину пользователя"""
-        if not self.user_carts.get(user_id, {}).get("items"):
+        msg = update.effective_message
+        if not self.user_carts.get(user_id, EMPTY_CART)["items"]:
             text = "Ваша корзина пуста!"
             if edit_message:
                 await update.callback_query.edit_message_text(text=text)
             else:
-                await update.message.reply_text(text)
+                await msg.reply_text(text)
             return
         
         cart = self.user_carts[user_id]["items"]
         editing_index = self.current_editing.get(user_id, 0)
         items_text = []
         
-        for idx, item in enumerate(cart):
-            p = item["product"]
-            qty = item["quantity"]
+        for idx, product_id in enumerate(self.user_carts[user_id]["order"]):
+            p = PRODUCTS_BY_ID[product_id]
+            qty = cart[product_id]
             prefix = "➡️ " if idx == editing_index else "▪️ "
             items_text.append(
                 f"{prefix}{p['title']}\n"
@@ -498,84 +943,62 @@ class BotHandlers:
         
         response = "🛒 Ваша корзина:\n\n" + "\n\n".join(items_text)
         
-        # Генерация клавиатуры
-        buttons = []
-        if cart:
-            buttons.append([
-                InlineKeyboardButton("◀️", callback_data="prev_item"),
-                InlineKeyboardButton("▶️", callback_data="next_item"),
-            ])
-        
-        buttons.extend([
-            [
-                InlineKeyboardButton("❌ Удалить", callback_data="remove_item"),
-                InlineKeyboardButton("🚚 Доставка", callback_data="select_delivery_date")
-            ],
-            [
-                InlineKeyboardButton("➕ Добавить еще", switch_inline_query_current_chat=""),
-                InlineKeyboardButton("👨‍💼 Менеджер", url="https://t.me/kras_yulya")
-            ]
-        ])
-        
         if edit_message:
             await update.callback_query.edit_message_text(
                 text=response,
-                reply_markup=InlineKeyboardMarkup(buttons))
+                reply_markup=CART_MARKUP)
         else:
-            await update.message.reply_text(
+            await msg.reply_text(
                 response,
-                reply_markup=InlineKeyboardMarkup(buttons))
+                reply_markup=CART_MARKUP)
     
     async def show_delivery_dates(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показывает доступные даты доставки"""
-        user_id = update.callback_query.from_user.id
-        DELIVERY_DATES, DATE_KEYS = generate_delivery_dates()
-        keyboard = [
-            [InlineKeyboardButton(DELIVERY_DATES[i], callback_data=DATE_KEYS[i]) 
-             for i in range(0, 7, 3)],
-            [InlineKeyboardButton(DELIVERY_DATES[i], callback_data=DATE_KEYS[i]) 
-             for i in range(1, 7, 3)],
-            [InlineKeyboardButton(DELIVERY_DATES[i], callback_data=DATE_KEYS[i]) 
-             for i in range(2, 7, 3)],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_cart")]
-        ]
+        # Клавиатура меняется только со сменой дня
+        today = date.today()
+        if today != self._dates_markup_day:
+            DELIVERY_DATES, DATE_KEYS = generate_delivery_dates(today)
+            keyboard = [
+                [InlineKeyboardButton(DELIVERY_DATES[i], callback_data=DATE_KEYS[i]) 
+                 for i in range(0, 7, 3)],
+                [InlineKeyboardButton(DELIVERY_DATES[i], callback_data=DATE_KEYS[i]) 
+                 for i in range(1, 7, 3)],
+                [InlineKeyboardButton(DELIVERY_DATES[i], callback_data=DATE_KEYS[i]) 
+                 for i in range(2, 7, 3)],
+                [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_cart")]
+            ]
+            self._dates_markup = InlineKeyboardMarkup(keyboard)
+            self._dates_markup_day = today
         await update.callback_query.edit_message_text(
             text="📅 Выберите дату доставки:\n\nДоступные даты на ближайшую неделю:",
-            reply_markup=InlineKeyboardMarkup(keyboard))
+            reply_markup=self._dates_markup)
     
     async def show_delivery_times(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показывает доступные интервалы доставки"""
-        user_id = update.callback_query.from_user.id
-        keyboard = [
-            [InlineKeyboardButton(interval, callback_data=f"delivery_time_{interval}") 
-             for interval in DELIVERY_TIME_INTERVALS[i:i+2]]
-            for i in range(0, len(DELIVERY_TIME_INTERVALS)-1, 2)  # Исключаем последний интервал
-        ]
-        # Добавляем последний интервал как отдельную кнопку внизу
-        keyboard.append([InlineKeyboardButton(DELIVERY_TIME_INTERVALS[-1], callback_data=f"delivery_time_{DELIVERY_TIME_INTERVALS[-1]}")])
-        keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_dates")])
-        
         await update.callback_query.edit_message_text(
             text="🕒 Выберите интервал доставки:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=DELIVERY_TIMES_MARKUP
         )
     
     async def process_delivery_time(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обрабатывает выбор времени доставки и оформляет заказ"""
         query = update.callback_query
-        await query.answer()
         
-        user = query.from_user
+        user = update.effective_user
         user_id = user.id
         time_str = query.data.split("_", 2)[-1]
         date_str = self.selected_dates.get(user_id)
         
         if not date_str:
-            await query.answer("Ошибка: дата не выбрана")
+            # На callback уже ответил handle_callback_query, второй answer Telegram отклонит
+            await query.edit_message_text(
+                "Ошибка: дата не выбрана. Выберите дату доставки заново.",
+                reply_markup=BACK_TO_MENU_MARKUP
+            )
             return
         
         # Проверка регистрации (хотя уже должна быть)
-        organization, contact_person = self.db.get_client(user.id)
+        organization, contact_person = await self._get_client(user.id)
         if not organization:
             await query.edit_message_text(
                 "Перед оформлением заказа необходимо зарегистрироваться!"
@@ -583,50 +1006,50 @@ class BotHandlers:
             return
         
         # Формирование информации о заказе
-        cart = self.user_carts.get(user_id, {}).get("items", [])
+        cart = self.user_carts.get(user_id, EMPTY_CART)["items"]
         if not cart:
             await query.edit_message_text("Ваша корзина пуста!")
             return
             
         order_lines = []
+        order_items = []
         
-        for item in cart:
-            p = item["product"]
-            qty = item["quantity"]
+        for product_id in self.user_carts[user_id]["order"]:
+            p = PRODUCTS_BY_ID[product_id]
+            qty = cart[product_id]
             order_lines.append(f"▪️ {p['title']} - {qty} шт.")
+            order_items.append({"product": p, "quantity": qty})
         
-        delivery_date = datetime.strptime(date_str, "%Y-%m-%d")
-        start_time_str = time_str.split(" - ")[0]
-        delivery_datetime = datetime.strptime(f"{date_str} {start_time_str}", "%Y-%m-%d %H:%M")
+        delivery_date = date.fromisoformat(date_str)
+        delivery_datetime = delivery_start(delivery_date, time_str)
         
         delivery_info = (
             f"\n📅 Дата доставки: {delivery_date.strftime('%d.%m.%Y')}\n"
             f"🕒 Время доставки: {time_str}\n"
         )
         
-        order_text = "✅ Ваш заказ оформлен!\n\n" + "\n".join(order_lines) + delivery_info
+        order_lines_text = "\n".join(order_lines)  # Общий для сообщения клиенту и админам
+        order_text = "✅ Ваш заказ оформлен!\n\n" + order_lines_text + delivery_info
 
         # Сохраняем заказ в базу данных
         order_data = {
-            "items": [{
-                "product": item["product"],
-                "quantity": item["quantity"]
-            } for item in cart],
+            "items": order_items,
             "organization": organization,
             "contact_person": contact_person,
             "username": user.username
         }
         
         try:
-            order_id = self.db.save_order(
+            order_id = await self._db(
+                self.db.save_order,
                 user_id=user_id,
                 order_data=order_data,
-                delivery_date=date_str,
+                delivery_date=delivery_date,
                 delivery_time=time_str
             )
-            logger.info(f"Order #{order_id} saved successfully for user {user_id}")
+            logger.info("Order #%s saved successfully for user %s", order_id, user_id)
         except Exception as e:
-            logger.error(f"Error saving order: {e}")
+            logger.error("Error saving order: %s", e)
             await query.edit_message_text(
                 "Произошла ошибка при сохранении заказа. Пожалуйста, попробуйте позже."
             )
@@ -640,21 +1063,16 @@ class BotHandlers:
             "admin_message_ids": {}  # Храним ID сообщений для каждого админа
         }
         
-        # Добавляем кнопку отмены заказа
-        keyboard = [
-            [InlineKeyboardButton("❌ Отменить заказ", callback_data="cancel_last_order")],
-            [InlineKeyboardButton("👨‍💼 Связаться с менеджером", url="https://t.me/Krash_order_Bot")]
-        ]
-        
-        # Проверяем, осталось ли до доставки больше 6 часов
+        # Кнопка отмены заказа, пока до доставки больше 6 часов
+        reply_markup = ORDER_PLACED_MARKUP
         time_left = delivery_datetime - datetime.now()
-        if time_left <= timedelta(hours=6):
+        if time_left <= CANCEL_DEADLINE:
             order_text += "\n\n⚠️ Отмена заказа возможна не позднее чем за 6 часов до доставки. Сейчас отменить заказ уже нельзя."
-            keyboard = [[InlineKeyboardButton("👨‍💼 Связаться с менеджером", url="https://t.me/Krash_order_Bot")]]
+            reply_markup = MANAGER_MARKUP
         
         await query.edit_message_text(
             text=order_text + "\nДля уточнения деталей с вами свяжется менеджер.",
-            reply_markup=InlineKeyboardMarkup(keyboard))
+            reply_markup=reply_markup)
         
         # Уведомление в группу
         if ADMIN_IDS:
@@ -665,34 +1083,41 @@ class BotHandlers:
                 f"📱 Телеграм: @{user.username if user.username else 'не указан'}\n"
                 f"📅 Доставка: {delivery_date.strftime('%d.%m.%Y')} {time_str}\n"
                 f"🆔 Номер заказа: {order_id}\n\n"
-                "Состав заказа:\n" + "\n".join(order_lines)
+                "Состав заказа:\n" + order_lines_text
             )
             
-            for admin_id in ADMIN_IDS:
-                try:
-                    kb = [[InlineKeyboardButton("📨 Написать клиенту", url=f"https://t.me/{user.username}")]] if user.username else None
-                    message = await context.bot.send_message(
-                        chat_id=admin_id,
-                        text=admin_message,
-                        reply_markup=InlineKeyboardMarkup(kb) if kb else None,
-                        disable_notification=True
-                    )
-                    self.last_orders[user_id]["admin_message_ids"][admin_id] = message.message_id
-                    logger.info(f"Уведомление отправлено в чат {admin_id}, message_id: {message.message_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки в чат {admin_id}: {e}")
+            kb = [[InlineKeyboardButton("📨 Написать клиенту", url=f"https://t.me/{user.username}")]] if user.username else None
+            admin_markup = InlineKeyboardMarkup(kb) if kb else None
+            admin_message_ids = self.last_orders[user_id]["admin_message_ids"]
+            
+            # Рассылка всем админам параллельно: ждём самый медленный ответ, а не сумму
+            admin_ids = tuple(ADMIN_IDS)
+            results = await asyncio.gather(*(
+                context.bot.send_message(
+                    chat_id=admin_id,
+                    text=admin_message,
+                    reply_markup=admin_markup,
+                    disable_notification=True
+                )
+                for admin_id in admin_ids
+            ), return_exceptions=True)
+            for admin_id, result in zip(admin_ids, results):
+                if isinstance(result, Exception):
+                    logger.error("Ошибка отправки в чат %s: %s", admin_id, result)
+                else:
+                    admin_message_ids[admin_id] = result.message_id
+                    logger.info("Уведомление отправлено в чат %s, message_id: %s", admin_id, result.message_id)
         else:
             logger.error("Не удалось отправить уведомление: ADMIN_IDS пуст!")
         
         # Очистка данных
-        self.user_carts[user_id] = {"items": []}
+        self.user_carts[user_id] = {"items": {}, "order": []}
         self.selected_dates.pop(user_id, None)
     
     async def cancel_last_order(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обрабатывает отмену заказа"""
         query = update.callback_query
-        await query.answer()
-        user_id = query.from_user.id
+        user_id = update.effective_user.id
         
         if user_id not in self.last_orders:
             await query.edit_message_text(text="У вас нет активных заказов для отмены.")
@@ -702,41 +1127,23 @@ class BotHandlers:
         delivery_datetime = order_data["delivery_datetime"]
         time_left = delivery_datetime - datetime.now()
         
-        if time_left <= timedelta(hours=6):
+        if time_left <= CANCEL_DEADLINE:
             order_text = "\n".join(order_data["order_text"].split("\n")[2:])  # Убираем "Ваш заказ оформлен"
             await query.edit_message_text(
                 text="⚠️ Отмена заказа возможна не позднее чем за 6 часов до доставки. Сейчас отменить заказ уже нельзя.\n\n" + 
                      order_text,
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("👨‍💼 Связаться с менеджером", url="https://t.me/Krash_order_Bot")]
-                ])
+                reply_markup=MANAGER_MARKUP
             )
             return
         
         # Отменяем заказ в базе данных
-        if not self.db.cancel_order(order_data["order_id"]):
+        if not await self._db(self.db.cancel_order, order_data["order_id"]):
             await query.edit_message_text(text="Не удалось отменить заказ. Пожалуйста, свяжитесь с менеджером.")
             return
         
-        # Уведомляем администраторов об отмене
+        # Уведомляем администраторов об отмене в фоне, не задерживая ответ клиенту
         if ADMIN_IDS:
-            cancel_message = (
-                f"⚠️ ЗАКАЗ ОТМЕНЕН ⚠️\n\n"
-                f"Заказ №{order_data['order_id']} был отменен клиентом.\n"
-                f"Оригинальное сообщение:\n\n{order_data['order_text']}"
-            )
-            for admin_id in ADMIN_IDS:
-                try:
-                    reply_to_message_id = order_data["admin_message_ids"].get(admin_id)
-                    await context.bot.send_message(
-                        chat_id=admin_id,
-                        text=cancel_message,
-                        reply_to_message_id=reply_to_message_id,
-                        disable_notification=True
-                    )
-                    logger.info(f"Уведомление об отмене заказа #{order_data['order_id']} отправлено в чат {admin_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке уведомления об отмене в чат {admin_id}: {e}")
+            context.application.create_task(self._notify_admins_cancelled(context, order_data))
 
         # Обновляем сообщение для пользователя
         order_text = "\n".join(order_data["order_text"].split("\n")[2:])  # Убираем "Ваш заказ оформлен"
@@ -748,116 +1155,130 @@ class BotHandlers:
         # Удаляем информацию о заказе
         del self.last_orders[user_id]
     
+    async def _notify_admins_cancelled(self, context: ContextTypes.DEFAULT_TYPE, order_data: Dict[str, Any]):
+        """Отправляет администраторам уведомление об отмене заказа"""
+        cancel_message = (
+            f"⚠️ ЗАКАЗ ОТМЕНЕН ⚠️\n\n"
+            f"Заказ №{order_data['order_id']} был отменен клиентом.\n"
+            f"Оригинальное сообщение:\n\n{order_data['order_text']}"
+        )
+        # Копия множества: задача работает параллельно с /add_admin и /remove_admin
+        admin_ids = tuple(ADMIN_IDS)
+        admin_message_ids = order_data["admin_message_ids"]
+        results = await asyncio.gather(*(
+            context.bot.send_message(
+                chat_id=admin_id,
+                text=cancel_message,
+                reply_to_message_id=admin_message_ids.get(admin_id),
+                disable_notification=True
+            )
+            for admin_id in admin_ids
+        ), return_exceptions=True)
+        for admin_id, result in zip(admin_ids, results):
+            if isinstance(result, Exception):
+                logger.error("Ошибка при отправке уведомления об отмене в чат %s: %s", admin_id, result)
+            else:
+                logger.info("Уведомление об отмене заказа #%s отправлено в чат %s", order_data['order_id'], admin_id)
+    
     async def handle_callback_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик callback запросов"""
         query = update.callback_query
-        await query.answer()
+        # Подтверждение callback идёт параллельно с обработкой, а не перед ней
+        ack_task = asyncio.create_task(query.answer())
         
-        user_id = query.from_user.id
         data = query.data
         
         try:
-            # Обработка навигации по товарам в корзине
-            if data == "prev_item":
-                if user_id in self.current_editing:
-                    cart = self.user_carts.get(user_id, {}).get("items", [])
-                    if cart:
-                        self.current_editing[user_id] = (self.current_editing[user_id] - 1) % len(cart)
-                        await self.show_cart(update, context, user_id, edit_message=True)
-            
-            elif data == "next_item":
-                if user_id in self.current_editing:
-                    cart = self.user_carts.get(user_id, {}).get("items", [])
-                    if cart:
-                        self.current_editing[user_id] = (self.current_editing[user_id] + 1) % len(cart)
-                        await self.show_cart(update, context, user_id, edit_message=True)
-            
-            # Удаление товара из корзины
-            elif data == "remove_item":
-                if user_id in self.current_editing:
-                    idx = self.current_editing[user_id]
-                    if user_id in self.user_carts and idx < len(self.user_carts[user_id]["items"]):
-                        del self.user_carts[user_id]["items"][idx]
-                        
-                        # Обновляем индекс редактирования
-                        if self.user_carts[user_id]["items"]:
-                            self.current_editing[user_id] = min(idx, len(self.user_carts[user_id]["items"]) - 1)
-                        else:
-                            del self.current_editing[user_id]
-                        
-                        await self.show_cart(update, context, user_id, edit_message=True)
-            
-            # Выбор даты доставки
-            elif data == "select_delivery_date":
-                await self.show_delivery_dates(update, context)
-            
-            # Возврат в корзину
-            elif data == "back_to_cart":
-                await self.show_cart(update, context, user_id, edit_message=True)
-            
-            # Возврат к выбору даты
-            elif data == "back_to_dates":
-                await self.show_delivery_dates(update, context)
-            
-            # Обработка выбора даты доставки
-            elif data.startswith("delivery_date_"):
-                date_str = data.split("_", 2)[-1]
-                self.selected_dates[user_id] = date_str
-                await self.show_delivery_times(update, context)
-            
-            # Обработка выбора времени доставки
-            elif data.startswith("delivery_time_"):
-                await self.process_delivery_time(update, context)
-            
-            # Отмена последнего заказа
-            elif data == "cancel_last_order":
-                await self.cancel_last_order(update, context)
-            
-            # Просмотр активных заказов
-            elif data == "my_orders":
-                await self.show_active_orders(update, context)
-            
-            # Открытие каталога
-            elif data == "catalog":
-                await query.edit_message_text(
-                    text="Меню товаров:",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
-                        "Открыть меню", switch_inline_query_current_chat=""
-                    )]])
-                )
-            
-            # Информация о боте
-            elif data == "about":
-                await query.edit_message_text(
-                    text="ℹ️ О нас:\n\nМы доставляем свежие круассаны и выпечку каждое утро!\n\n"
-                         "Работаем с 6:00 до 13:00\n"
-                         "По вопросам сотрудничества: @Krash_order_Bot",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_menu")]])
-                )
-            
-            # Возврат в главное меню
-            elif data == "back_to_menu":
-                await self._show_main_menu(update)
+            handler = self._cb_map.get(data)
+            if handler is None:
+                for prefix, prefix_handler in self._cb_prefix:
+                    if data.startswith(prefix):
+                        handler = prefix_handler
+                        break
+            if handler is not None:
+                await handler(update, context)
         
         except Exception as e:
-            logger.error(f"Error in callback handler: {e}")
+            logger.error("Error in callback handler: %s", e)
             await query.edit_message_text("Произошла ошибка. Пожалуйста, попробуйте позже.")
+        finally:
+            await ack_task
+    
+    # Обработка навигации по товарам в корзине
+    async def _cb_prev_item(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        if user_id in self.current_editing:
+            cart = self.user_carts.get(user_id, EMPTY_CART)["items"]
+            if cart:
+                self.current_editing[user_id] = (self.current_editing[user_id] - 1) % len(cart)
+                await self.show_cart(update, context, user_id, edit_message=True)
+    
+    async def _cb_next_item(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        if user_id in self.current_editing:
+            cart = self.user_carts.get(user_id, EMPTY_CART)["items"]
+            if cart:
+                self.current_editing[user_id] = (self.current_editing[user_id] + 1) % len(cart)
+                await self.show_cart(update, context, user_id, edit_message=True)
+    
+    # Удаление товара из корзины
+    async def _cb_remove_item(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        if user_id in self.current_editing:
+            idx = self.current_editing[user_id]
+            cart = self.user_carts.get(user_id)
+            if cart and idx < len(cart["order"]):
+                del cart["items"][cart["order"].pop(idx)]
+                
+                # Обновляем индекс редактирования
+                if cart["order"]:
+                    self.current_editing[user_id] = min(idx, len(cart["order"]) - 1)
+                else:
+                    del self.current_editing[user_id]
+                
+                await self.show_cart(update, context, user_id, edit_message=True)
+    
+    # Возврат в корзину
+    async def _cb_back_to_cart(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await self.show_cart(update, context, update.effective_user.id, edit_message=True)
+    
+    # Обработка выбора даты доставки
+    async def _cb_pick_date(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        self.selected_dates[update.effective_user.id] = query.data.split("_", 2)[-1]
+        await self.show_delivery_times(update, context)
+    
+    # Открытие каталога
+    async def _cb_catalog(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.callback_query.edit_message_text(
+            text="Меню товаров:",
+            reply_markup=OPEN_MENU_MARKUP
+        )
+    
+    # Информация о боте
+    async def _cb_about(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.callback_query.edit_message_text(
+            text="ℹ️ О нас:\n\nМы доставляем свежие круассаны и выпечку каждое утро!\n\n"
+                 "Работаем с 6:00 до 13:00\n"
+                 "По вопросам сотрудничества: @Krash_order_Bot",
+            reply_markup=BACK_TO_MENU_MARKUP
+        )
     
     async def show_active_orders(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показывает активные заказы пользователя"""
         query = update.callback_query
-        user_id = query.from_user.id
-        order = self.db.get_active_order(user_id)
+        user_id = update.effective_user.id
+        order = await self._db(self.db.get_active_order, user_id)
         
         if not order:
             await query.edit_message_text(
                 text="У вас нет активных заказов.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_menu")]])
+                reply_markup=BACK_TO_MENU_MARKUP
             )
             return
         
         order_lines = []
-        for item in order["order_data"]["items"]:
+        for item in order.order_data["items"]:
             p = item["product"]
             qty = item["quantity"]
             order_lines.append(f"▪️ {p['title']} - {qty} шт.")
@@ -865,19 +1286,16 @@ class BotHandlers:
         order_text = (
             "📦 Ваш активный заказ:\n\n" +
             "\n".join(order_lines) +
-            f"\n\n📅 Дата доставки: {order['delivery_date']}" +
-            f"\n🕒 Время доставки: {order['delivery_time']}"
+            f"\n\n📅 Дата доставки: {order.delivery_date}" +
+            f"\n🕒 Время доставки: {order.delivery_time}"
         )
         
         keyboard = []
-        delivery_datetime = datetime.strptime(
-            f"{order['delivery_date']} {order['delivery_time'].split(' - ')[0]}",
-            "%Y-%m-%d %H:%M"
-        )
+        delivery_datetime = delivery_start(order.delivery_date, order.delivery_time)
         time_left = delivery_datetime - datetime.now()
         
-        if time_left > timedelta(hours=6):
-            keyboard.append([InlineKeyboardButton("❌ Отменить заказ", callback_data=f"cancel_order_{order['order_id']}")])
+        if time_left > CANCEL_DEADLINE:
+            keyboard.append([InlineKeyboardButton("❌ Отменить заказ", callback_data=f"cancel_order_{order.order_id}")])
         
         keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_menu")])
         
@@ -888,9 +1306,10 @@ class BotHandlers:
     
     async def admin_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /stats для админов"""
-        user_id = update.message.from_user.id
+        msg = update.effective_message
+        user_id = update.effective_user.id
         if user_id not in ADMIN_IDS:
-            await update.message.reply_text("Эта команда доступна только администраторам.")
+            await msg.reply_text("Эта команда доступна только администраторам.")
             return
         
         now = datetime.now()
@@ -899,32 +1318,29 @@ class BotHandlers:
         end_date = None
         
         if context.args:
-            date_input = context.args[0].strip()
-            parts = date_input.split('.')
-            if len(parts) != 2:
-                await update.message.reply_text("Некорректный формат. Используйте DD.MM для дня или MM.YYYY для месяца.")
+            match = STATS_ARG_RE.match(context.args[0].strip())
+            if not match:
+                await msg.reply_text("Некорректный формат. Используйте DD.MM для дня или MM.YYYY для месяца.")
                 return
             
+            first, second = match.groups()
             try:
-                if len(parts[1]) == 2:  # Формат DD.MM - день
-                    day, month = map(int, parts)
+                if len(second) == 2:  # Формат DD.MM - день
+                    day, month = int(first), int(second)
                     year = now.year
-                    target_date = datetime(year, month, day)
-                    start_date = end_date = target_date.strftime("%Y-%m-%d")
+                    target_date = date(year, month, day)
+                    start_date = end_date = target_date
                     date_display = target_date.strftime("%d.%m")
                     period_display = f"Данные за {date_display}"
-                elif len(parts[1]) == 4:  # Формат MM.YYYY - месяц
-                    month, year = map(int, parts)
+                else:  # Формат MM.YYYY - месяц
+                    month, year = int(first), int(second)
                     is_month = True
                     _, last_day = monthrange(year, month)
-                    start_date = datetime(year, month, 1).strftime("%Y-%m-%d")
-                    end_date = datetime(year, month, last_day).strftime("%Y-%m-%d")
-                    period_display = f"Данные с {datetime(year, month, 1).strftime('%d.%m')} по {datetime(year, month, last_day).strftime('%d.%m')}"
-                else:
-                    await update.message.reply_text("Некорректный формат. Используйте DD.MM для дня или MM.YYYY для месяца.")
-                    return
+                    start_date = date(year, month, 1)
+                    end_date = date(year, month, last_day)
+                    period_display = f"Данные с {start_date:%d.%m} по {end_date:%d.%m}"
             except ValueError:
-                await update.message.reply_text("Некорректный формат даты. Используйте DD.MM для дня или MM.YYYY для месяца.")
+                await msg.reply_text("Некорректный формат даты. Используйте DD.MM для дня или MM.YYYY для месяца.")
                 return
         else:
             # Без аргументов - текущий месяц
@@ -932,185 +1348,140 @@ class BotHandlers:
             year = now.year
             month = now.month
             _, last_day = monthrange(year, month)
-            start_date = datetime(year, month, 1).strftime("%Y-%m-%d")
-            end_date = datetime(year, month, last_day).strftime("%Y-%m-%d")
-            period_display = f"Данные с {datetime(year, month, 1).strftime('%d.%m')} по {datetime(year, month, last_day).strftime('%d.%m')}"
-        
-        # Запрос заказов за период
-        try:
-            self.db.cursor.execute("""
-                SELECT order_id, user_id, order_data, delivery_date, delivery_time 
-                FROM orders 
-                WHERE delivery_date BETWEEN %s AND %s AND status = 'active'
-            """, (start_date, end_date))
-            orders = self.db.cursor.fetchall()
-        except Exception as e:
-            logger.error(f"Error fetching orders for period {start_date} to {end_date}: {e}")
-            await update.message.reply_text("Ошибка при получении данных. Попробуйте позже.")
-            return
-        
-        if not orders:
-            await update.message.reply_text(f"Нет активных заказов за период {period_display}.")
-            return
-        
-        # Агрегация данных
-        if is_month:
-            # Группировка по дате и клиенту для месяца
-            date_user_orders = defaultdict(lambda: defaultdict(lambda: [0] * 13))
-            client_info = {}  # {user_id: (contact, org)}
-            
-            for order in orders:
-                order_data = order['order_data']  # Уже dict
-                user_id = order['user_id']
-                delivery_date = order['delivery_date']
-                if user_id not in client_info:
-                    client_info[user_id] = (order_data['contact_person'], order_data['organization'])
-                
-                quantities = date_user_orders[delivery_date][user_id]
-                for item in order_data['items']:
-                    prod_id = int(item['product']['id']) - 1
-                    if 0 <= prod_id < 13:
-                        quantities[prod_id] += item['quantity']
-            
-            # Подготовка CSV для месяца
-            csvfile = io.StringIO()
-            writer = csv.writer(csvfile, dialect='excel', delimiter=',')
-            
-            writer.writerow([period_display] + [''] * 14)
-            headers = [
-                'Дата', 'Клиент', 'Организация', 
-                'Классический', 'Миндальный', 'Заморозка/10шт', 'Пан-о-шоколя', 
-                'Ванильный', 'Шоколадный', 'Матча', 'Мини', 
-                'Улитка/Изюм', 'Улитка/Мак', 'Булка/Кардамон', 
-                'Комбо1', 'Комбо2'
-            ]
-            writer.writerow(headers)
-            
-            totals = [0] * 13
-            sorted_dates = sorted(date_user_orders.keys())  # Сортировка по датам
-            for date_str in sorted_dates:
-                user_data = date_user_orders[date_str]
-                sorted_users = sorted(user_data.keys())  # Сортировка по user_id или по имени, если нужно
-                for user_id in sorted_users:
-                    contact, org = client_info[user_id]
-                    quantities = user_data[user_id]
-                    date_dd_mm = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d.%m")
-                    writer.writerow([date_dd_mm, contact, org] + quantities)
-                    for i in range(13):
-                        totals[i] += quantities[i]
-            
-            writer.writerow(['Итого', '', ''] + totals)
-        else:
-            # Логика для дня (как раньше)
-            user_orders = {}
-            for order in orders:
-                order_data = order['order_data']
-                user_id = order['user_id']
-                if user_id not in user_orders:
-                    user_orders[user_id] = {
-                        'contact': order_data['contact_person'],
-                        'org': order_data['organization'],
-                        'quantities': [0] * 13
-                    }
-                
-                for item in order_data['items']:
-                    prod_id = int(item['product']['id']) - 1
-                    if 0 <= prod_id < 13:
-                        user_orders[user_id]['quantities'][prod_id] += item['quantity']
-            
-            csvfile = io.StringIO()
-            writer = csv.writer(csvfile, dialect='excel', delimiter=',')
-            
-            writer.writerow([period_display] + [''] * 14)
-            headers = [
-                '', 'Клиент', 'Организация', 
-                'Классический', 'Миндальный', 'Заморозка/10шт', 'Пан-о-шоколя', 
-                'Ванильный', 'Шоколадный', 'Матча', 'Мини', 
-                'Улитка/Изюм', 'Улитка/Мак', 'Булка/Кардамон', 
-                'Комбо1', 'Комбо2'
-            ]
-            writer.writerow(headers)
-            
-            sorted_users = sorted(user_orders.items(), key=lambda x: x[1]['contact'])
-            totals = [0] * 13
-            for user_id, data in sorted_users:
-                row = ['', data['contact'], data['org']] + data['quantities']
-                writer.writerow(row)
-                for i in range(13):
-                    totals[i] += data['quantities'][i]
+            start_date = date(year, month, 1)
+            end_date = date(year, month, last_day)
+            period_display = f"Данные с {start_date:%d.%m} по {end_date:%d.%m}"
+        
+        # Версия читается до запроса: изменение заказов во время выгрузки не оставит в кэше старый отчёт
+        cache_key = (self.db.orders_version, start_date, end_date, is_month)
+        csv_bytes = self._stats_cache.get(cache_key)
+        if csv_bytes is None:
+            # Выборка и формирование CSV одной задачей в пуле потоков, без промежуточного списка строк
+            try:
+                csv_bytes = await self._db(self._export_stats, start_date, end_date, is_month, period_display)
+            except Exception as e:
+                logger.error("Error exporting orders for period %s to %s: %s", start_date, end_date, e)
+                await msg.reply_text("Ошибка при получении данных. Попробуйте позже.")
+                return
             
-            writer.writerow(['Итого', '', ''] + totals)
+            if csv_bytes is None:
+                await msg.reply_text(f"Нет активных заказов за период {period_display}.")
+                return
+            self._stats_cache.set(cache_key, csv_bytes)
         
         # Отправка файла
-        csvfile.seek(0)
-        filename = f"orders_{start_date.replace('-', '')}_{end_date.replace('-', '')}.csv" if is_month else f"orders_{date_display}.csv"
-        await update.message.reply_document(
-            document=InputFile(csvfile, filename=filename)
+        filename = f"orders_{start_date:%Y%m%d}_{end_date:%Y%m%d}.csv" if is_month else f"orders_{date_display}.csv"
+        await msg.reply_document(
+            document=InputFile(csv_bytes, filename=filename)
         )
     
+    def _export_stats(self, start_date: date, end_date: date, is_month: bool, period_display: str) -> Optional[bytes]:
+        """CSV-отчёт /stats за период, записанный прямо из курсора; None, если заказов нет"""
+        with closing(self.db.iter_stats_rows(start_date, end_date, is_month)) as rows:
+            first = next(rows, None)
+            if first is None:
+                return None
+            # getvalue отдаёт внутренний буфер BytesIO, обычно без копирования; байты же и кэшируются
+            return self._build_stats_csv(chain((first,), rows), is_month, period_display).getvalue()
+    
+    @staticmethod
+    def _stats_csv_rows(orders, is_month: bool, period_display: str):
+        """Строки CSV-отчёта /stats по порядку: заголовок, клиенты, итог"""
+        yield (period_display, *STATS_TITLE_PADDING)
+        yield ('Дата' if is_month else '', *STATS_HEADER)
+        
+        # Кортежи из SQL уже в виде строк отчёта и уходят в CSV как есть: остаётся посчитать итог
+        totals = [0] * 13
+        for row in orders:
+            yield row
+            totals = list(map(add, totals, row[3:]))  # Поэлементное сложение без цикла на Python
+        
+        yield ('Итого', '', '', *totals)
+    
+    @staticmethod
+    def _build_stats_csv(orders, is_month: bool, period_display: str) -> io.BytesIO:
+        """Собирает CSV-отчёт /stats в байтовый буфер, готовый к отправке"""
+        # writerows обходит генератор строк внутри csv-модуля, экранируя поля
+        csvfile = io.BytesIO()
+        # utf-8-sig: BOM в начале файла, чтобы Excel открывал кириллицу без выбора кодировки
+        text = io.TextIOWrapper(csvfile, encoding='utf-8-sig', newline='', write_through=True)
+        csv.writer(text).writerows(BotHandlers._stats_csv_rows(orders, is_month, period_display))
+        text.detach()  # Иначе закрытие обёртки закроет и буфер
+        csvfile.seek(0)
+        return csvfile
+    
     async def add_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /add_admin"""
-        user_id = update.message.from_user.id
+        msg = update.effective_message
+        user_id = update.effective_user.id
         if user_id not in ADMIN_IDS:
-            await update.message.reply_text("Эта команда доступна только администраторам.")
+            await msg.reply_text("Эта команда доступна только администраторам.")
             return
         
         if not context.args:
-            await update.message.reply_text("Укажите ID пользователя для добавления в админы: /add_admin <user_id>")
+            await msg.reply_text("Укажите ID пользователя для добавления в админы: /add_admin <user_id>")
             return
         
-        try:
-            new_admin_id = int(context.args[0])
-            if new_admin_id not in ADMIN_IDS:
-                ADMIN_IDS.append(new_admin_id)
-                await update.message.reply_text(f"Пользователь {new_admin_id} добавлен в админы.")
-            else:
-                await update.message.reply_text("Этот пользователь уже администратор.")
-        except ValueError:
-            await update.message.reply_text("Некорректный ID пользователя.")
+        # Проверка регуляркой вместо перехвата ValueError от int()
+        arg = context.args[0].strip()
+        if not USER_ID_RE.match(arg):
+            await msg.reply_text("Некорректный ID пользователя.")
+            return
+        
+        new_admin_id = int(arg)
+        if new_admin_id not in ADMIN_IDS:
+            ADMIN_IDS.add(new_admin_id)
+            await msg.reply_text(f"Пользователь {new_admin_id} добавлен в админы.")
+        else:
+            await msg.reply_text("Этот пользователь уже администратор.")
     
     async def remove_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /remove_admin"""
-        user_id = update.message.from_user.id
+        msg = update.effective_message
+        user_id = update.effective_user.id
         if user_id not in ADMIN_IDS:
-            await update.message.reply_text("Эта команда доступна только администраторам.")
+            await msg.reply_text("Эта команда доступна только администраторам.")
             return
         
         if not context.args:
-            await update.message.reply_text("Укажите ID пользователя для удаления из админов: /remove_admin <user_id>")
+            await msg.reply_text("Укажите ID пользователя для удаления из админов: /remove_admin <user_id>")
             return
         
-        try:
-            admin_id = int(context.args[0])
-            if admin_id in ADMIN_IDS:
-                ADMIN_IDS.remove(admin_id)
-                await update.message.reply_text(f"Пользователь {admin_id} удалён из админов.")
-            else:
-                await update.message.reply_text("Этот пользователь не является администратором.")
-        except ValueError:
-            await update.message.reply_text("Некорректный ID пользователя.")
+        arg = context.args[0].strip()
+        if not USER_ID_RE.match(arg):
+            await msg.reply_text("Некорректный ID пользователя.")
+            return
+        
+        admin_id = int(arg)
+        if admin_id in ADMIN_IDS:
+            ADMIN_IDS.discard(admin_id)
+            await msg.reply_text(f"Пользователь {admin_id} удалён из админов.")
+        else:
+            await msg.reply_text("Этот пользователь не является администратором.")
 
-    async def _show_main_menu(self, update: Update):
+    async def _show_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показывает главное меню"""
         await update.callback_query.edit_message_text(
             text="Выберите действие:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("📋 Каталог", callback_data="catalog")],
-                [InlineKeyboardButton("📦 Мои заказы", callback_data="my_orders")],
-                [InlineKeyboardButton("ℹ️ О нас", callback_data="about")]
-            ])
+            reply_markup=MAIN_MENU_MARKUP
         )
 
 # Определение обработчика ошибок
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.error(f"Update {update} caused error {context.error}")
+    logger.error("Update %s caused error %s", update, context.error)
     if update.message:
         await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте позже или свяжитесь с поддержкой.")
 
 def main():
     """Запуск бота"""
     try:
-        application = ApplicationBuilder().token(TOKEN).build()
+        application = (
+            ApplicationBuilder()
+            .token(TOKEN)
+            .connection_pool_size(TG_CONNECTION_POOL_SIZE)
+            .pool_timeout(TG_POOL_TIMEOUT)
+            .build()
+        )
         handlers = BotHandlers()
         
         # Регистрация InlineQueryHandler для меню
@@ -1138,7 +1509,9 @@ def main():
         
         # Регистрация обработчиков команд
         application.add_handler(CommandHandler("info", handlers.check_client_info))
-        application.add_handler(CommandHandler("stats", handlers.admin_stats))
+        # PTB обрабатывает обновления по очереди: /stats с тяжёлой выгрузкой не должна задерживать
+        # остальных. Обработчик не трогает состояние пользователей, поэтому выполняется параллельно
+        application.add_handler(CommandHandler("stats", handlers.admin_stats, block=False))
         application.add_handler(CommandHandler("add_admin", handlers.add_admin))
         application.add_handler(CommandHandler("remove_admin", handlers.remove_admin))
         
@@ -1150,9 +1523,10 @@ def main():
         application.run_polling()
         
     except Exception as e:
-        logger.error(f"Ошибка при запуске бота: {e}")
+        logger.error("Ошибка при запуске бота: %s", e)
     finally:
         if hasattr(handlers, 'db'):
+            handlers._db_executor.shutdown(wait=True)
             handlers.db.close()
 
 if __name__ == '__main__':